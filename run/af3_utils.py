@@ -165,7 +165,15 @@ def get_af3_parser() -> FileArgumentParser:
         "--jax_compilation_cache_dir",
         type=str,
         default=None,
-        help="Path to a directory for the JAX compilation cache."
+        help="Path to a directory for the persistent JAX compilation cache."
+        " Defaults to '~/.cache/alphafold3/jax'."
+    )
+    parser.add_argument(
+        "--debug_jax_cache",
+        type=int,
+        default=0,
+        help="Whether to log JAX compilation cache hits and explain cache"
+        " misses. Defaults to 0 (False)."
     )
     parser.add_argument(
         "--buckets",
@@ -177,13 +185,40 @@ def get_af3_parser() -> FileArgumentParser:
         " exactly that number of tokens. Defaults to"
         " '256,512,768,1024,1280,1536,2048,2560,3072,3584,4096,4608,5120'."
     )
+    parser.add_argument(
+        "--batch_seeds",
+        type=int,
+        default=0,
+        help="Whether to run inference for all seeds of a fold input as a single"
+        " batched forward pass. This reduces per-seed overhead but device memory"
+        " use grows with the number of seeds. Defaults to 0 (False)."
+    )
+    parser.add_argument(
+        "--sort_window_size",
+        type=int,
+        default=16,
+        help="Number of fold inputs to load ahead and sort by bucket size, so"
+        " inputs of the same size run consecutively. The next window is loaded"
+        " in the background while the current one runs. Set to 0 to load and"
+        " sort all fold inputs before running any of them. Defaults to 16."
+    )
+    parser.add_argument(
+        "--precompile_buckets",
+        type=int,
+        default=0,
+        help="Whether to compile the model for the bucket sizes used by each"
+        " window of fold inputs (see --sort_window_size) before processing them,"
+        " so that no compilation happens between inputs. With --batch_seeds, the"
+        " batched forward pass is compiled for each bucket size and number of"
+        " seeds instead. Defaults to 0 (False)."
+    )
     parser.add_argument(
         "--cuda_compute_7x",
         type=int,
         default=0,
         help="If using a GPU with CUDA compute capability of 7.x, you must"
-        " set this flag to 1. This will set "
-        " XLA_FLAGS='--xla_disable_hlo_passes=custom-kernel-fusion-rewriter'."
+        " set this flag to 1. This will add"
+        " '--xla_disable_hlo_passes=custom-kernel-fusion-rewriter' to XLA_FLAGS."
         " Defaults to 0 (False)."
     )
 
@@ -213,6 +248,9 @@ def get_af3_args(arg_file: Optional[str] = None) -> Dict[str, Any]:
     args.run_inference = binary_to_bool(args.run_inference)
     args.cuda_compute_7x = binary_to_bool(args.cuda_compute_7x)
     args.save_embeddings = binary_to_bool(args.save_embeddings)
+    args.debug_jax_cache = binary_to_bool(args.debug_jax_cache)
+    args.precompile_buckets = binary_to_bool(args.precompile_buckets)
+    args.batch_seeds = binary_to_bool(args.batch_seeds)
     args.buckets = sorted([int(b) for b in args.buckets.split(',')])
     args.run_data_pipeline = False # Kuhlman Lab installation handles MSAs and templates differently
     
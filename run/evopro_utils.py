@@ -11,20 +11,19 @@ from alphafold3.jax.attention import attention
 from alphafold3.model.post_processing import post_process_inference_result
 
 from af3_utils import load_fold_inputs_from_path, get_af3_args
-from run_af3 import ModelRunner, make_model_config, predict_structure
+from run_af3 import (
+    ModelRunner,
+    configure_jax_compilation_cache,
+    make_model_config,
+    predict_structure,
+    set_xla_flags,
+)
 
 
 def init_af3(proc_id: int, arg_file: str, lengths: Sequence[Union[int, Sequence[int]]]) -> Callable:
-    # Work around for a known XLA issue:
-    # https://github.com/google-deepmind/alphafold3/blob/main/docs/performance.md#compilation-time-workaround-with-xla-flags
-    os.environ["XLA_FLAGS"] = "--xla_gpu_enable_triton_gemm=false"
-    
     args_dict = get_af3_args(arg_file)
-
-    if args_dict['jax_compilation_cache_dir'] is not None:
-        jax.config.update(
-            'jax_compilation_cache_dir', args_dict['jax_compilation_cache_dir']
-        )
+    set_xla_flags(cuda_compute_7x=args_dict["cuda_compute_7x"])
+    configure_jax_compilation_cache(args_dict)
 
     # Fail early on incompatible devices, only in init.
     gpu_devices = jax.local_devices(backend='gpu')
@@ -60,7 +59,6 @@ def init_af3(proc_id: int, arg_file: str, lengths: Sequence[Union[int, Sequence[
         )
         print('\n'.join(notice))
 
-    devices = jax.local_devices(backend='gpu')
     model_runner = ModelRunner(
         config=make_model_config(
             flash_attention_implementation=typing.cast(
@@ -68,7 +66,7 @@ def init_af3(proc_id: int, arg_file: str, lengths: Sequence[Union[int, Sequence[
             ),
             num_diffusion_samples=1,
         ),
-        device=devices[0],
+        device=gpu_devices[0],
         model_dir=pathlib.Path(args_dict["model_dir"]),
     )
 
@@ -108,11 +106,7 @@ def init_af3(proc_id: int, arg_file: str, lengths: Sequence[Union[int, Sequence[
 
 def run_af3(json_str: str, proc_id: int, arg_file: str, buckets: Tuple[int], compiled_runner: ModelRunner) -> Sequence[Dict[str, Any]]:
     args_dict = get_af3_args(arg_file)
-    
-    if args_dict['jax_compilation_cache_dir'] is not None:
-        jax.config.update(
-            'jax_compilation_cache_dir', args_dict['jax_compilation_cache_dir']
-        )
+    configure_jax_compilation_cache(args_dict)
 
     # Convert json_str to fold_input and make prediction
     fold_input = [i for i in load_fold_inputs_from_path(json_str)][0]
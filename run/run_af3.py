@@ -1,11 +1,13 @@
 """AlphaFold 3 structure prediction script.
 """
 
-from collections.abc import Callable, Sequence
-import csv
+from collections.abc import Callable, Iterable, Iterator, Sequence
+import concurrent.futures
+import contextlib
 import dataclasses
 import datetime
 import functools
+import itertools
 import multiprocessing
 import os
 import pathlib
@@ -14,11 +16,12 @@ import string
 import textwrap
 import time
 import typing
-from typing import overload, Dict, Any
+from typing import Dict, Any
 
 from absl import flags
 from alphafold3.common import folding_input
 from alphafold3.constants import chemical_components
+from alphafold3.constants import residue_names
 import alphafold3.cpp
 from alphafold3.data import featurisation
 from alphafold3.data import pipeline
@@ -28,10 +31,12 @@ from alphafold3.model import params
 from alphafold3.model import post_processing
 from alphafold3.model.components import utils
 from alphafold3.model.diffusion import model
+from alphafold3.model.pipeline import pipeline as model_pipeline
 import haiku as hk
 import jax
 from jax import numpy as jnp
 import numpy as np
+import rdkit.Chem as rd_chem
 
 from af3_utils import (
     get_af3_args,
@@ -42,6 +47,18 @@ from af3_utils import (
 
 _HOME_DIR = pathlib.Path(os.environ.get('HOME'))
 _DEFAULT_DB_DIR = _HOME_DIR / 'public_databases'
+_DEFAULT_JAX_COMPILATION_CACHE_DIR = _HOME_DIR / '.cache' / 'alphafold3' / 'jax'
+
+# The output terms of use are the same for all outputs, so only read them once.
+# They may be missing when the package isn't installed (e.g. in tests), in which
+# case no terms of use file is written.
+_OUTPUT_TERMS_OF_USE: str | None
+try:
+    _OUTPUT_TERMS_OF_USE = (
+        pathlib.Path(alphafold3.cpp.__file__).parent / 'OUTPUT_TERMS_OF_USE.md'
+    ).read_text()
+except FileNotFoundError:
+    _OUTPUT_TERMS_OF_USE = None
 
 
 # Binary paths.
@@ -140,6 +157,62 @@ _NHMMER_N_CPU = flags.DEFINE_integer(
 )
 
 
+def configure_jax_compilation_cache(args_dict: Dict[str, Any]) -> None:
+    """Enables the persistent JAX compilation cache.
+
+    The cache is always used, so that only the first run for a given bucket size
+    pays the tracing and XLA compilation cost.
+
+    Args:
+        args_dict: Parsed arguments, see `af3_utils.get_af3_args`. Uses
+            `jax_compilation_cache_dir` (defaults to ~/.cache/alphafold3/jax if
+            None) and `debug_jax_cache`.
+    """
+    jax_compilation_cache_dir = (
+        args_dict['jax_compilation_cache_dir']
+        or _DEFAULT_JAX_COMPILATION_CACHE_DIR.as_posix()
+    )
+    jax.config.update('jax_compilation_cache_dir', jax_compilation_cache_dir)
+    jax.config.update('jax_persistent_cache_min_entry_size_bytes', 0)
+    jax.config.update('jax_persistent_cache_min_compile_time_secs', 0)
+    if args_dict['debug_jax_cache']:
+        jax.config.update('jax_explain_cache_misses', True)
+        jax.config.update(
+            'jax_debug_log_modules',
+            'jax._src.compiler,jax._src.compilation_cache',
+        )
+
+
+@contextlib.contextmanager
+def _timed(message: str) -> Iterator[None]:
+    """Prints the message on entry, and how long the block took on exit."""
+    print(f'{message}...')
+    start_time_ns = time.perf_counter_ns()
+    yield
+    elapsed_seconds = (time.perf_counter_ns() - start_time_ns) / 1e9
+    print(f'{message} took {elapsed_seconds:.2f} seconds.')
+
+
+def set_xla_flags(cuda_compute_7x: bool = False) -> None:
+    """Sets XLA_FLAGS, which must happen before the JAX backend is initialised.
+
+    Args:
+        cuda_compute_7x: Whether the GPU has CUDA compute capability 7.x, which
+            requires disabling the custom kernel fusion rewriter.
+    """
+    xla_flags = [
+        # Work around for a known XLA issue:
+        # https://github.com/google-deepmind/alphafold3/blob/main/docs/performance.md#compilation-time-workaround-with-xla-flags
+        '--xla_gpu_enable_triton_gemm=false',
+        # Compile in parallel, which otherwise can be very slow when the CUDA
+        # driver and ptxas versions don't match.
+        f'--xla_gpu_force_compilation_parallelism={min(os.cpu_count() or 1, 16)}',
+    ]
+    if cuda_compute_7x:
+        xla_flags.append('--xla_disable_hlo_passes=custom-kernel-fusion-rewriter')
+    os.environ['XLA_FLAGS'] = ' '.join(xla_flags)
+
+
 def make_model_config(
     *,
     flash_attention_implementation: attention.Implementation = 'triton',
@@ -168,59 +241,230 @@ class ModelRunner:
         self._model_config = config
         self._device = device
         self._model_dir = model_dir
+        self._compiled_models: dict[int, jax.stages.Compiled] = {}
+        # Batched forward passes, per bucket size and number of seeds.
+        self._compiled_batched_models: dict[
+            tuple[int, int], jax.stages.Compiled
+        ] = {}
+        # Feature keys with valid types, per bucket size (number of tokens).
+        self._valid_feat_keys: dict[int, frozenset[str]] = {}
+        self._model_params: hk.Params | None = None
+
+        @hk.transform
+        def forward_fn(batch):
+            result = model.Diffuser(self._model_config)(batch)
+            # Upcast bfloat16 outputs as part of the forward pass, so that XLA
+            # fuses the casts into the compiled executable.
+            return jax.tree.map(
+                lambda x: x.astype(jnp.float32) if x.dtype == jnp.bfloat16 else x,
+                result,
+            )
+
+        # Jitting is lazy, so building the forward passes here is cheap.
+        self._model: Callable[
+            [hk.Params, jnp.ndarray, features.BatchDict], model.ModelResult
+        ] = jax.jit(forward_fn.apply, device=self._device)
+        # Maps over a leading axis of both the rng keys and the examples, sharing
+        # the parameters.
+        self._batched_model: Callable[
+            [hk.Params, jnp.ndarray, features.BatchDict], model.ModelResult
+        ] = jax.jit(
+            jax.vmap(forward_fn.apply, in_axes=(None, 0, 0)), device=self._device
+        )
 
-    @functools.cached_property
+    @property
     def model_params(self) -> hk.Params:
-        """Loads model parameters from the model directory."""
-        return params.get_model_haiku_params(model_dir=self._model_dir)
+        """Loads model parameters from the model directory on first access."""
+        if self._model_params is None:
+            self._model_params = params.get_model_haiku_params(
+                model_dir=self._model_dir
+            )
+        return self._model_params
 
-    @functools.cached_property
-    def _model(
-        self,
-    ) -> Callable[[jnp.ndarray, features.BatchDict], model.ModelResult]:
-        """Loads model parameters and returns a jitted model forward pass."""
+    def check_model_params(self) -> None:
+        """Checks the model parameters can be read, without loading them."""
+        if self._model_params is None:
+            params.check_model_haiku_params_exist(model_dir=self._model_dir)
 
-        @hk.transform
-        def forward_fn(batch):
-            return model.Diffuser(self._model_config)(batch)
+    def precompile(
+        self,
+        buckets: Sequence[int],
+        conformer_max_iterations: int | None = None,
+        num_seeds: int | None = None,
+    ) -> None:
+        """Ahead-of-time compiles the model forward pass for each bucket size.
+
+        Featurised examples are padded to a fixed shape per bucket, so a dummy
+        poly-glycine input with exactly `bucket` tokens has the same input
+        shapes as any real input that falls into that bucket.
+
+        Args:
+            buckets: Bucket sizes (number of tokens) to compile the model for.
+            conformer_max_iterations: Optional override for maximum number of
+                iterations to run for RDKit conformer search.
+            num_seeds: If set, compile the batched forward pass used by
+                `run_inference_batched` for this many seeds instead of the
+                single-seed forward pass used by `run_inference`.
+        """
+        ccd = chemical_components.cached_ccd()
+        for bucket in buckets:
+            if num_seeds is None:
+                if bucket in self._compiled_models:
+                    continue
+                message = f'Compiling model for bucket size {bucket}'
+            else:
+                if (bucket, num_seeds) in self._compiled_batched_models:
+                    continue
+                message = (
+                    f'Compiling batched model for bucket size {bucket} and'
+                    f' {num_seeds} seeds'
+                )
+            with _timed(message):
+                self._compile_bucket(
+                    bucket, buckets, ccd, conformer_max_iterations, num_seeds
+                )
 
-        return functools.partial(
-            jax.jit(forward_fn.apply, device=self._device), self.model_params
+    def _compile_bucket(
+        self,
+        bucket: int,
+        buckets: Sequence[int],
+        ccd: chemical_components.Ccd,
+        conformer_max_iterations: int | None,
+        num_seeds: int | None,
+    ) -> None:
+        """Compiles the (batched) model forward pass for a single bucket size."""
+        dummy_fold_input = folding_input.Input(
+            name=f'precompile_{bucket}',
+            chains=[
+                folding_input.ProteinChain(
+                    id='A',
+                    sequence='G' * bucket,
+                    ptms=[],
+                    paired_msa='',
+                    unpaired_msa='',
+                    templates=[],
+                )
+            ],
+            rng_seeds=[0],
+        )
+        (dummy_example,) = featurisation.featurise_input(
+            fold_input=dummy_fold_input,
+            buckets=buckets,
+            ccd=ccd,
+            conformer_max_iterations=conformer_max_iterations,
         )
+        # Match the keys passed at run time, whose shape and dtype depend on the
+        # configured PRNG implementation.
+        key_spec = jax.eval_shape(jax.random.PRNGKey, 0)
+        if num_seeds is None:
+            example_spec = jax.tree_util.tree_map(
+                lambda x: jax.ShapeDtypeStruct(x.shape, x.dtype),
+                utils.remove_invalidly_typed_feats(dummy_example),
+            )
+            rng_key_spec = jax.ShapeDtypeStruct(key_spec.shape, key_spec.dtype)
+            self._compiled_models[bucket] = self._model.lower(
+                self.model_params, rng_key_spec, example_spec
+            ).compile()
+        else:
+            # The batched forward pass maps over a leading seed axis of both the
+            # rng keys and the examples.
+            example_spec = jax.tree_util.tree_map(
+                lambda x: jax.ShapeDtypeStruct((num_seeds, *x.shape), x.dtype),
+                utils.remove_invalidly_typed_feats(dummy_example),
+            )
+            rng_key_spec = jax.ShapeDtypeStruct(
+                (num_seeds, *key_spec.shape), key_spec.dtype
+            )
+            self._compiled_batched_models[(bucket, num_seeds)] = (
+                self._batched_model.lower(
+                    self.model_params, rng_key_spec, example_spec
+                ).compile()
+            )
+
+    def _remove_invalidly_typed_feats(
+        self, featurised_example: features.BatchDict
+    ) -> features.BatchDict:
+        """Like `utils.remove_invalidly_typed_feats`, but cached per bucket."""
+        # Which features have valid types is fixed for a given bucket, so only
+        # inspect the dtypes the first time a bucket is seen.
+        num_tokens = featurised_example['token_index'].shape[-1]
+        if (valid_feat_keys := self._valid_feat_keys.get(num_tokens)) is None:
+            valid_feat_keys = frozenset(
+                utils.remove_invalidly_typed_feats(featurised_example)
+            )
+            self._valid_feat_keys[num_tokens] = valid_feat_keys
+        return {k: v for k, v in featurised_example.items() if k in valid_feat_keys}
 
     def run_inference(
         self, featurised_example: features.BatchDict, rng_key: jnp.ndarray
     ) -> model.ModelResult:
         """Computes a forward pass of the model on a featurised example."""
+        # Transfer the host (numpy) arrays straight to the target device, rather
+        # than first materialising them on the default device with jnp.asarray.
         featurised_example = jax.device_put(
-            jax.tree_util.tree_map(
-                jnp.asarray, utils.remove_invalidly_typed_feats(featurised_example)
-            ),
-            self._device,
+            self._remove_invalidly_typed_feats(featurised_example), self._device
         )
 
-        result = self._model(rng_key, featurised_example)
-        result = jax.tree.map(np.asarray, result)
-        result = jax.tree.map(
-            lambda x: x.astype(jnp.float32) if x.dtype == jnp.bfloat16 else x,
-            result,
-        )
-        result = dict(result)
-        identifier = self.model_params['__meta__']['__identifier__'].tobytes()
+        model_params = self.model_params
+        num_tokens = featurised_example['token_index'].shape[-1]
+        if (compiled_model := self._compiled_models.get(num_tokens)) is not None:
+            result = compiled_model(model_params, rng_key, featurised_example)
+        else:
+            result = self._model(model_params, rng_key, featurised_example)
+        # Fetch the whole result tree with a single transfer.
+        result = dict(jax.device_get(result))
+        identifier = model_params['__meta__']['__identifier__'].tobytes()
         result['__identifier__'] = identifier
         return result
 
+    def run_inference_batched(
+        self,
+        featurised_examples: Sequence[features.BatchDict],
+        rng_keys: jnp.ndarray,
+    ) -> list[model.ModelResult]:
+        """Computes forward passes on several featurised examples in one call.
+
+        Args:
+            featurised_examples: Featurised examples which must all have the same
+                shapes, e.g. the examples of a single fold input for each seed.
+            rng_keys: The rng keys, stacked along the leading axis, one per
+                example.
+
+        Returns:
+            The model result for each example, in order. Device memory use grows
+            linearly with the number of examples.
+        """
+        batch = jax.tree.map(
+            lambda *feats: np.stack(feats),
+            *[self._remove_invalidly_typed_feats(e) for e in featurised_examples],
+        )
+        batch = jax.device_put(batch, self._device)
+
+        model_params = self.model_params
+        num_tokens = batch['token_index'].shape[-1]
+        batched_model = self._compiled_batched_models.get(
+            (num_tokens, len(featurised_examples)), self._batched_model
+        )
+        batched_result = jax.device_get(
+            batched_model(model_params, rng_keys, batch)
+        )
+        identifier = model_params['__meta__']['__identifier__'].tobytes()
+        results = []
+        for i in range(len(featurised_examples)):
+            result = dict(jax.tree.map(lambda x, i=i: x[i], batched_result))
+            result['__identifier__'] = identifier
+            results.append(result)
+        return results
+
     def extract_structures(
         self,
         batch: features.BatchDict,
         result: model.ModelResult,
         target_name: str,
-    ) -> list[model.InferenceResult]:
-        """Generates structures from model outputs."""
-        return list(
-            model.Diffuser.get_inference_result(
-                batch=batch, result=result, target_name=target_name
-            )
+    ) -> Iterator[model.InferenceResult]:
+        """Generates structures from model outputs, one sample at a time."""
+        yield from model.Diffuser.get_inference_result(
+            batch=batch, result=result, target_name=target_name
         )
 
     def extract_embeddings(
@@ -254,69 +498,150 @@ class ResultsForSeed:
     embeddings: dict[str, np.ndarray] | None = None
 
 
-def predict_structure(
+def featurise_input_in_background(
+    fold_input: folding_input.Input,
+    buckets: Sequence[int] | None,
+    ccd: chemical_components.Ccd,
+    conformer_max_iterations: int | None = None,
+) -> Iterator[features.BatchDict]:
+    """Yields a featurised example per seed, featurising one seed ahead.
+
+    The next seed is featurised on a worker thread while the caller consumes the
+    current example (e.g. runs model inference on it), so that the device is not
+    left idle during featurisation of all but the first seed.
+
+    Args:
+        fold_input: The input to featurise.
+        buckets: Bucket sizes to pad the data to, see `featurisation.featurise_input`.
+        ccd: The chemical components dictionary.
+        conformer_max_iterations: Optional override for maximum number of iterations
+            to run for RDKit conformer search.
+
+    Yields:
+        The featurised example for each seed in `fold_input.rng_seeds`, in order.
+    """
+
+    def featurise_seed(seed: int) -> features.BatchDict:
+        (example,) = featurisation.featurise_input(
+            fold_input=dataclasses.replace(fold_input, rng_seeds=[seed]),
+            buckets=buckets,
+            ccd=ccd,
+            verbose=True,
+            conformer_max_iterations=conformer_max_iterations,
+        )
+        return example
+
+    seeds = fold_input.rng_seeds
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        next_example = executor.submit(featurise_seed, seeds[0])
+        for next_seed in seeds[1:]:
+            example = next_example.result()
+            next_example = executor.submit(featurise_seed, next_seed)
+            yield example
+        yield next_example.result()
+
+
+def iter_predict_structure(
     fold_input: folding_input.Input,
     model_runner: ModelRunner,
     buckets: Sequence[int] | None = None,
     conformer_max_iterations: int | None = None,
-) -> Sequence[ResultsForSeed]:
-    """Runs the full inference pipeline to predict structures for each seed."""
+    batch_seeds: bool = False,
+) -> Iterator[ResultsForSeed]:
+    """Runs the full inference pipeline, yielding the results seed by seed.
+
+    Each seed's results are yielded as soon as they are extracted, so a consumer
+    can write and release them while later seeds are still running.
+
+    If `batch_seeds` is True, inference for all seeds runs as a single batched
+    (vmapped) forward pass, which uses proportionally more device memory.
+    """
 
     print(f'Featurising data for seeds {fold_input.rng_seeds}...')
-    featurisation_start_time = time.time()
+    # cached_ccd is memoised on user_ccd, so all fold inputs with the same (or no)
+    # user CCD share a single Ccd across the whole batch.
     ccd = chemical_components.cached_ccd(user_ccd=fold_input.user_ccd)
-    featurised_examples = featurisation.featurise_input(
+    featurised_examples = featurise_input_in_background(
         fold_input=fold_input,
         buckets=buckets,
         ccd=ccd,
-        verbose=True,
         conformer_max_iterations=conformer_max_iterations,
     )
-    print(
-        f'Featurising data for seeds {fold_input.rng_seeds} took'
-        f' {time.time() - featurisation_start_time:.2f} seconds.'
-    )
-    all_inference_start_time = time.time()
-    all_inference_results = []
-    for seed, example in zip(fold_input.rng_seeds, featurised_examples):
-        print(f'Running model inference for seed {seed}...')
-        inference_start_time = time.time()
-        rng_key = jax.random.PRNGKey(seed)
-        result = model_runner.run_inference(example, rng_key)
-        print(
-            f'Running model inference for seed {seed} took'
-            f' {time.time() - inference_start_time:.2f} seconds.'
-        )
-        print(f'Extracting output structures (one per sample) for seed {seed}...')
-        extract_structures = time.time()
-        inference_results = model_runner.extract_structures(
-            batch=example, result=result, target_name=fold_input.name
-        )
-        print(
-            f'Extracting output structures (one per sample) for seed {seed} took'
-            f' {time.time() - extract_structures:.2f} seconds.'
+    # Derive the keys for all seeds up front on the host, so that no device
+    # allocation is needed per seed before each inference call.
+    with jax.default_device(jax.local_devices(backend='cpu')[0]):
+        rng_keys = np.stack(
+            [jax.random.PRNGKey(seed) for seed in fold_input.rng_seeds]
         )
+    with _timed(
+        'Running model inference and extracting output structures for seeds'
+        f' {fold_input.rng_seeds}'
+    ):
+        batched_results = None
+        if batch_seeds:
+            # All seeds of a fold input are padded to the same shapes, so they
+            # can run as a single batch.
+            featurised_examples = list(featurised_examples)
+            with _timed(f'Running model inference for seeds {fold_input.rng_seeds}'):
+                batched_results = model_runner.run_inference_batched(
+                    featurised_examples, rng_keys
+                )
+        for i, (seed, rng_key, example) in enumerate(
+            zip(fold_input.rng_seeds, rng_keys, featurised_examples)
+        ):
+            with _timed(
+                'Running model inference and extracting output structures for'
+                f' seed {seed}'
+            ):
+                if batched_results is not None:
+                    result = batched_results[i]
+                else:
+                    with _timed(f'Running model inference for seed {seed}'):
+                        result = model_runner.run_inference(example, rng_key)
+                with _timed(
+                    f'Extracting output structures (one per sample) for seed {seed}'
+                ):
+                    inference_results = list(
+                        model_runner.extract_structures(
+                            batch=example, result=result, target_name=fold_input.name
+                        )
+                    )
 
-        embeddings = model_runner.extract_embeddings(result)
+                embeddings = model_runner.extract_embeddings(result)
 
-        all_inference_results.append(
-            ResultsForSeed(
-                seed=seed,
-                inference_results=inference_results,
-                full_fold_input=fold_input,
-                embeddings=embeddings,
-            )
-        )
-        print(
-            'Running model inference and extracting output structures for seed'
-            f' {seed} took {time.time() - inference_start_time:.2f} seconds.'
+                results_for_seed = ResultsForSeed(
+                    seed=seed,
+                    inference_results=inference_results,
+                    full_fold_input=fold_input,
+                    embeddings=embeddings,
+                )
+            if batched_results is not None:
+                # Release this seed's raw model outputs.
+                batched_results[i] = None
+            yield results_for_seed
+
+
+def predict_structure(
+    fold_input: folding_input.Input,
+    model_runner: ModelRunner,
+    buckets: Sequence[int] | None = None,
+    conformer_max_iterations: int | None = None,
+    batch_seeds: bool = False,
+) -> Sequence[ResultsForSeed]:
+    """Runs the full inference pipeline to predict structures for each seed.
+
+    See `iter_predict_structure`, which avoids holding the results for all seeds
+    at once.
+    """
+    return list(
+        iter_predict_structure(
+            fold_input=fold_input,
+            model_runner=model_runner,
+            buckets=buckets,
+            conformer_max_iterations=conformer_max_iterations,
+            batch_seeds=batch_seeds,
         )
-    print(
-        'Running model inference and extracting output structures for seeds'
-        f' {fold_input.rng_seeds} took'
-        f' {time.time() - all_inference_start_time:.2f} seconds.'
     )
-    return all_inference_results
 
 
 def write_fold_input_json(
@@ -332,93 +657,259 @@ def write_fold_input_json(
 
 
 def write_outputs(
-    all_inference_results: Sequence[ResultsForSeed],
+    all_inference_results: Iterable[ResultsForSeed],
     output_dir: os.PathLike[str] | str,
     job_name: str,
 ) -> None:
-    """Writes outputs to the specified output directory."""
+    """Writes outputs to the specified output directory.
+
+    The results may be a lazy iterable (see `iter_predict_structure`): each
+    seed's writes are submitted as soon as it is produced, and only the top
+    ranked result is kept until all seeds are done.
+    """
     ranking_scores = []
     max_ranking_score = None
     max_ranking_result = None
 
-    output_terms = (
-        pathlib.Path(alphafold3.cpp.__file__).parent / 'OUTPUT_TERMS_OF_USE.md'
-    ).read_text()
-
     os.makedirs(output_dir, exist_ok=True)
-    for results_for_seed in all_inference_results:
-        seed = results_for_seed.seed
-        for sample_idx, result in enumerate(results_for_seed.inference_results):
-            sample_dir = os.path.join(output_dir, f'seed-{seed}_sample-{sample_idx}')
-            os.makedirs(sample_dir, exist_ok=True)
-            post_processing.write_output(
-                inference_result=result, output_dir=sample_dir
-            )
-            ranking_score = float(result.metadata['ranking_score'])
-            ranking_scores.append((seed, sample_idx, ranking_score))
-            if max_ranking_score is None or ranking_score > max_ranking_score:
-                max_ranking_score = ranking_score
-                max_ranking_result = result
-            
-        if embeddings := results_for_seed.embeddings:
-            embeddings_dir = os.path.join(output_dir, f'seed-{seed}_embeddings')
-            os.makedirs(embeddings_dir, exist_ok=True)
-            post_processing.write_embeddings(
-                embeddings=embeddings, output_dir=embeddings_dir
+    # Post-processing and writing each sample is independent of the others, so
+    # do it on a thread pool and only wait for all writes before returning.
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(8, os.cpu_count() or 1)
+    ) as executor:
+        write_futures = []
+        for results_for_seed in all_inference_results:
+            seed = results_for_seed.seed
+            for sample_idx, result in enumerate(results_for_seed.inference_results):
+                sample_dir = os.path.join(output_dir, f'seed-{seed}_sample-{sample_idx}')
+                # Seeds aren't deduplicated, so the directory may already exist.
+                os.makedirs(sample_dir, exist_ok=True)
+                write_futures.append(
+                    executor.submit(
+                        post_processing.write_output,
+                        inference_result=result,
+                        output_dir=sample_dir,
+                    )
+                )
+                ranking_score = float(result.metadata['ranking_score'])
+                ranking_scores.append((seed, sample_idx, ranking_score))
+                if max_ranking_score is None or ranking_score > max_ranking_score:
+                    max_ranking_score = ranking_score
+                    max_ranking_result = result
+
+            if embeddings := results_for_seed.embeddings:
+                embeddings_dir = os.path.join(output_dir, f'seed-{seed}_embeddings')
+                os.makedirs(embeddings_dir, exist_ok=True)
+                write_futures.append(
+                    executor.submit(
+                        post_processing.write_embeddings,
+                        embeddings=embeddings,
+                        output_dir=embeddings_dir,
+                    )
+                )
+
+        if max_ranking_result is not None:  # True iff ranking_scores non-empty.
+            write_futures.append(
+                executor.submit(
+                    post_processing.write_output,
+                    inference_result=max_ranking_result,
+                    output_dir=output_dir,
+                    # The output terms of use are the same for all seeds/samples.
+                    terms_of_use=_OUTPUT_TERMS_OF_USE,
+                    name=job_name,
+                )
             )
 
-    if max_ranking_result is not None:  # True iff ranking_scores non-empty.
-        post_processing.write_output(
-            inference_result=max_ranking_result,
-            output_dir=output_dir,
-            # The output terms of use are the same for all seeds/samples.
-            terms_of_use=output_terms,
-            name=job_name,
-        )
+        # Re-raise any exception from the writes.
+        for future in write_futures:
+            future.result()
+
+    if ranking_scores:
         # Save csv of ranking scores with seeds and sample indices, to allow easier
         # comparison of ranking scores across different runs.
         with open(os.path.join(output_dir, 'ranking_scores.csv'), 'wt') as f:
-            writer = csv.writer(f)
-            writer.writerow(['seed', 'sample', 'ranking_score'])
-            writer.writerows(ranking_scores)
+            f.write(
+                'seed,sample,ranking_score\n'
+                + ''.join(
+                    f'{seed},{sample_idx},{ranking_score}\n'
+                    for seed, sample_idx, ranking_score in ranking_scores
+                )
+            )
+
+
+def _num_heavy_atoms(
+    ccd: chemical_components.Ccd, res_name: str, drop_leaving_atoms: bool
+) -> int:
+    """Returns the number of heavy atoms of a CCD component (1 if unknown).
+
+    Args:
+        ccd: The chemical components dictionary.
+        res_name: The component name, e.g. HEM.
+        drop_leaving_atoms: Whether to exclude leaving atoms (e.g. OXT), which
+            are removed when the component is bonded within a polymer.
+    """
+    res = ccd.get(res_name)
+    if res is None:
+        return 1
+    type_symbols = res.get('_chem_comp_atom.type_symbol', ())
+    leaving_flags = (
+        res.get('_chem_comp_atom.pdbx_leaving_atom_flag', ())
+        if drop_leaving_atoms
+        else ()
+    )
+    num_heavy_atoms = 0
+    for i, type_symbol in enumerate(type_symbols):
+        if type_symbol.upper() in ('H', 'D'):
+            continue
+        if i < len(leaving_flags) and leaving_flags[i] == 'Y':
+            continue
+        num_heavy_atoms += 1
+    return max(num_heavy_atoms, 1)
+
+
+def estimate_num_tokens(fold_input: folding_input.Input) -> int:
+    """Estimates the number of tokens of a fold input without featurising it.
+
+    Mirrors the tokenisation used in featurisation: standard polymer residues
+    are one token each, while modified residues and ligands are one token per
+    heavy atom, counted from the CCD used for the fold input (or from RDKit for
+    ligands defined by SMILES).
+    """
+    ccd = chemical_components.cached_ccd(user_ccd=fold_input.user_ccd)
+    num_tokens = 0
+    for chain in fold_input.chains:
+        if isinstance(chain, folding_input.Ligand):
+            if chain.smiles is not None:
+                mol = rd_chem.MolFromSmiles(chain.smiles)
+                num_tokens += mol.GetNumHeavyAtoms() if mol is not None else 1
+            else:
+                num_tokens += sum(
+                    _num_heavy_atoms(ccd, ccd_id, drop_leaving_atoms=False)
+                    for ccd_id in chain.ccd_ids
+                )
+            continue
+        if isinstance(chain, folding_input.ProteinChain):
+            standard_residues = (
+                *residue_names.PROTEIN_TYPES_WITH_UNKNOWN,
+                residue_names.MSE,
+            )
+        else:
+            standard_residues = residue_names.NUCLEIC_TYPES_WITH_2_UNKS
+        for res_name in chain.to_ccd_sequence():
+            if res_name in standard_residues:
+                num_tokens += 1
+            else:
+                num_tokens += _num_heavy_atoms(
+                    ccd, res_name, drop_leaving_atoms=True
+                )
+    return num_tokens
+
+
+def assign_bucket(fold_input: folding_input.Input, buckets: Sequence[int]) -> int:
+    """Returns the (estimated) bucket size the fold input will be padded to."""
+    return model_pipeline.calculate_bucket_size(
+        estimate_num_tokens(fold_input), buckets
+    )
+
+
+def sorted_fold_input_windows(
+    fold_inputs: Iterable[folding_input.Input],
+    buckets: Sequence[int],
+    window_size: int,
+) -> Iterator[list[folding_input.Input]]:
+    """Yields consecutive windows of fold inputs, each sorted by bucket size.
+
+    Running inputs that fall into the same bucket consecutively means each bucket
+    is compiled at most once and stays hot in the compilation cache. Loading fold
+    inputs can be slow though (e.g. when MSAs are fetched with MMseqs2), so rather
+    than loading all inputs before processing the first, they are loaded a window
+    at a time, with the next window loaded on a worker thread while the caller
+    processes the current one.
+
+    Args:
+        fold_inputs: The fold inputs, which are consumed lazily.
+        buckets: Bucket sizes, see `process_fold_input`.
+        window_size: Number of fold inputs to load and sort together. If 0, all
+            fold inputs are loaded and sorted at once.
+
+    Yields:
+        Windows of up to `window_size` fold inputs, sorted by (estimated) bucket
+        size and number of tokens.
+    """
+    fold_inputs = iter(fold_inputs)
+
+    def sort_key(fold_input: folding_input.Input) -> tuple[int, int]:
+        num_tokens = estimate_num_tokens(fold_input)
+        return model_pipeline.calculate_bucket_size(num_tokens, buckets), num_tokens
+
+    def load_window() -> list[folding_input.Input]:
+        window = list(itertools.islice(fold_inputs, window_size or None))
+        window.sort(key=sort_key)
+        return window
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        next_window = executor.submit(load_window)
+        while window := next_window.result():
+            next_window = executor.submit(load_window)
+            yield window
+
+
+def precompile_fold_input_window(
+    model_runner: ModelRunner,
+    fold_inputs: Sequence[folding_input.Input],
+    buckets: Sequence[int],
+    conformer_max_iterations: int | None = None,
+    batch_seeds: bool = False,
+) -> None:
+    """Compiles the forward passes a window of fold inputs will run.
+
+    With `batch_seeds`, inference runs through the batched forward pass, which
+    is compiled per bucket size and number of seeds.
+    """
+    window_buckets: dict[int | None, set[int]] = {}
+    for fold_input in fold_inputs:
+        num_seeds = len(fold_input.rng_seeds) if batch_seeds else None
+        window_buckets.setdefault(num_seeds, set()).add(
+            assign_bucket(fold_input, buckets)
+        )
+    for num_seeds, bucket_sizes in window_buckets.items():
+        model_runner.precompile(
+            buckets=sorted(bucket_sizes),
+            conformer_max_iterations=conformer_max_iterations,
+            num_seeds=num_seeds,
+        )
+
+
+@functools.cache
+def _db_dir_template(path_with_db_dir: str) -> string.Template:
+    """Returns the (cached) template for a path that may contain ${DB_DIR}."""
+    return string.Template(path_with_db_dir)
 
 
 def replace_db_dir(path_with_db_dir: str, db_dirs: Sequence[str]) -> str:
     """Replaces the DB_DIR placeholder in a path with the given DB_DIR."""
-    template = string.Template(path_with_db_dir)
-    if 'DB_DIR' in template.get_identifiers():
-        for db_dir in db_dirs:
-            path = template.substitute(DB_DIR=db_dir)
-            if os.path.exists(path):
-                return path
-        raise FileNotFoundError(
-            f'{path_with_db_dir} with ${{DB_DIR}} not found in any of {db_dirs}.'
-        )
+    # Only parse the path as a template if it can contain the placeholder.
+    if 'DB_DIR' in path_with_db_dir:
+        template = _db_dir_template(path_with_db_dir)
+        if 'DB_DIR' in template.get_identifiers():
+            candidate_paths = [
+                template.substitute(DB_DIR=db_dir) for db_dir in db_dirs
+            ]
+            for path in candidate_paths:
+                if os.path.exists(path):
+                    return path
+            raise FileNotFoundError(
+                f'{path_with_db_dir} with ${{DB_DIR}} not found in any of {db_dirs}.'
+            )
     if not os.path.exists(path_with_db_dir):
         raise FileNotFoundError(f'{path_with_db_dir} does not exist.')
     return path_with_db_dir
 
 
-@overload
-def process_fold_input(
-    fold_input: folding_input.Input,
-    data_pipeline_config: pipeline.DataPipelineConfig | None,
-    model_runner: None,
-    output_dir: os.PathLike[str] | str,
-    buckets: Sequence[int] | None = None,
-) -> folding_input.Input:
-    ...
-
-
-@overload
-def process_fold_input(
-    fold_input: folding_input.Input,
-    data_pipeline_config: pipeline.DataPipelineConfig | None,
-    model_runner: ModelRunner,
-    output_dir: os.PathLike[str] | str,
-    buckets: Sequence[int] | None = None,
-) -> Sequence[ResultsForSeed]:
-    ...
+def _is_non_empty_dir(path: os.PathLike[str] | str) -> bool:
+    """Returns whether the directory has any entries, without listing them all."""
+    with os.scandir(path) as entries:
+        return next(entries, None) is not None
 
 
 def process_fold_input(
@@ -428,7 +919,8 @@ def process_fold_input(
     output_dir: os.PathLike[str] | str,
     buckets: Sequence[int] | None = None,
     conformer_max_iterations: int | None = None,
-) -> folding_input.Input | Sequence[ResultsForSeed]:
+    batch_seeds: bool = False,
+) -> folding_input.Input:
     """Runs data pipeline and/or inference on a single fold input.
 
     Args:
@@ -444,9 +936,13 @@ def process_fold_input(
             is more than the largest bucket size.
         conformer_max_iterations: Optional override for maximum number of iterations
             to run for RDKit conformer search.
+        batch_seeds: Whether to run inference for all seeds as a single batched
+            forward pass.
 
     Returns:
-        The processed fold input, or the inference results for each seed.
+        The processed fold input. Inference results are written to `output_dir`
+        seed by seed rather than returned, so that they don't all have to be
+        held in memory; use `predict_structure` to get them instead.
 
     Raises:
         ValueError: If the fold input has no chains.
@@ -456,7 +952,7 @@ def process_fold_input(
     if not fold_input.chains:
         raise ValueError('Fold input has no chains.')
 
-    if os.path.exists(output_dir) and os.listdir(output_dir):
+    if os.path.exists(output_dir) and _is_non_empty_dir(output_dir):
         new_output_dir = (
             f'{output_dir}_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}'
         )
@@ -468,9 +964,11 @@ def process_fold_input(
 
     if model_runner is not None:
         # If we're running inference, check we can load the model parameters before
-        # (possibly) launching the data pipeline.
+        # (possibly) launching the data pipeline. The parameters themselves are
+        # only loaded when inference needs them, so they aren't held in memory
+        # while the data pipeline runs.
         print('Checking we can load the model parameters...')
-        _ = model_runner.model_params
+        model_runner.check_model_params()
 
     if data_pipeline_config is None:
         print('Skipping data pipeline...')
@@ -483,38 +981,35 @@ def process_fold_input(
     write_fold_input_json(fold_input, output_dir)
     if model_runner is None:
         print('Skipping inference...')
-        output = fold_input
     else:
         print(
             f'Predicting 3D structure for {fold_input.name} for seed(s)'
             f' {fold_input.rng_seeds}...'
         )
-        all_inference_results = predict_structure(
-            fold_input=fold_input,
-            model_runner=model_runner,
-            buckets=buckets,
-            conformer_max_iterations=conformer_max_iterations,
-        )
         print(
             f'Writing outputs for {fold_input.name} for seed(s)'
-            f' {fold_input.rng_seeds}...'
+            f' {fold_input.rng_seeds} as they are predicted...'
         )
+        # Stream the results so that each seed is written, and released, while
+        # later seeds are still running.
         write_outputs(
-            all_inference_results=all_inference_results,
+            all_inference_results=iter_predict_structure(
+                fold_input=fold_input,
+                model_runner=model_runner,
+                buckets=buckets,
+                conformer_max_iterations=conformer_max_iterations,
+                batch_seeds=batch_seeds,
+            ),
             output_dir=output_dir,
             job_name=fold_input.sanitised_name(),
         )
-        output = all_inference_results
 
     print(f'Done processing fold input {fold_input.name}.')
-    return output
+    return fold_input
 
 
 def main(args_dict: Dict[str, Any]) -> None:
-    if args_dict['jax_compilation_cache_dir'] is not None:
-        jax.config.update(
-            'jax_compilation_cache_dir', args_dict['jax_compilation_cache_dir']
-        )
+    configure_jax_compilation_cache(args_dict)
 
     if args_dict["json_path"] is None == args_dict["input_dir"] is None:
         raise ValueError(
@@ -553,8 +1048,12 @@ def main(args_dict: Dict[str, Any]) -> None:
             'Exactly one of --json_path or --input_dir must be specified.'
         )
 
+    buckets = tuple(int(bucket) for bucket in args_dict["buckets"])
+
+    gpu_devices = []
     if args_dict["run_inference"]:
         # Fail early on incompatible devices, but only if we're running inference.
+        # The devices are only queried once, and reused to build the model runner.
         gpu_devices = jax.local_devices(backend='gpu')
         if gpu_devices:
             compute_capability = float(gpu_devices[0].compute_capability)
@@ -615,8 +1114,7 @@ def main(args_dict: Dict[str, Any]) -> None:
         data_pipeline_config = None
 
     if args_dict["run_inference"]:
-        devices = jax.local_devices(backend='gpu')
-        print(f'Found local devices: {devices}')
+        print(f'Found local devices: {gpu_devices}')
 
         print('Building model from scratch...')
         model_runner = ModelRunner(
@@ -627,7 +1125,7 @@ def main(args_dict: Dict[str, Any]) -> None:
                 num_diffusion_samples=args_dict["num_diffusion_samples"],
                 return_embeddings=args_dict["save_embeddings"],
             ),
-            device=devices[0],
+            device=gpu_devices[0],
             model_dir=pathlib.Path(args_dict["model_dir"]),
         )
     else:
@@ -636,30 +1134,34 @@ def main(args_dict: Dict[str, Any]) -> None:
 
     print('Processing fold inputs.')
     num_fold_inputs = 0
-    for fold_input in fold_inputs:
-        print(f'Processing fold input #{num_fold_inputs + 1}')
-        process_fold_input(
-            fold_input=fold_input,
-            data_pipeline_config=data_pipeline_config,
-            model_runner=model_runner,
-            output_dir=os.path.join(args_dict["output_dir"], fold_input.sanitised_name()),
-            buckets=tuple(int(bucket) for bucket in args_dict["buckets"]),
-            conformer_max_iterations=args_dict["conformer_max_iterations"],
-        )
-        num_fold_inputs += 1
+    for fold_input_window in sorted_fold_input_windows(
+        fold_inputs, buckets, window_size=args_dict["sort_window_size"]
+    ):
+        if model_runner is not None and args_dict["precompile_buckets"]:
+            precompile_fold_input_window(
+                model_runner,
+                fold_input_window,
+                buckets,
+                conformer_max_iterations=args_dict["conformer_max_iterations"],
+                batch_seeds=args_dict["batch_seeds"],
+            )
+        for fold_input in fold_input_window:
+            print(f'Processing fold input #{num_fold_inputs + 1}')
+            process_fold_input(
+                fold_input=fold_input,
+                data_pipeline_config=data_pipeline_config,
+                model_runner=model_runner,
+                output_dir=os.path.join(args_dict["output_dir"], fold_input.sanitised_name()),
+                buckets=buckets,
+                conformer_max_iterations=args_dict["conformer_max_iterations"],
+                batch_seeds=args_dict["batch_seeds"],
+            )
+            num_fold_inputs += 1
 
     print(f'Done processing {num_fold_inputs} fold inputs.')
 
 
 if __name__ == '__main__':
-    # Work around for a known XLA issue:
-    # https://github.com/google-deepmind/alphafold3/blob/main/docs/performance.md#compilation-time-workaround-with-xla-flags
-    os.environ["XLA_FLAGS"] = "--xla_gpu_enable_triton_gemm=false"
-
     args_dict = get_af3_args()
-
-    # Add required flag for CUDA compute capability 7.x
-    if args_dict["cuda_compute_7x"]:
-        os.environ["XLA_FLAGS"] = "--xla_disable_hlo_passes=custom-kernel-fusion-rewriter"
-
+    set_xla_flags(cuda_compute_7x=args_dict["cuda_compute_7x"])
     main(args_dict)
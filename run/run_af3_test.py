@@ -0,0 +1,311 @@
+"""Tests for run_af3."""
+
+import os
+from unittest import mock
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from alphafold3.common import folding_input
+import jax
+import numpy as np
+
+import run_af3
+
+
+def _protein(chain_id: str, sequence: str, ptms=()) -> folding_input.ProteinChain:
+    return folding_input.ProteinChain(
+        id=chain_id,
+        sequence=sequence,
+        ptms=list(ptms),
+        paired_msa='',
+        unpaired_msa='',
+        templates=[],
+    )
+
+
+def _fold_input(name: str, *chains, rng_seeds=(1,)) -> folding_input.Input:
+    return folding_input.Input(
+        name=name, chains=list(chains), rng_seeds=list(rng_seeds)
+    )
+
+
+class EstimateNumTokensTest(parameterized.TestCase):
+
+    @parameterized.named_parameters(
+        dict(
+            testcase_name='protein',
+            chains=[_protein('A', 'ACDEFGHIKL')],
+            expected_num_tokens=10,
+        ),
+        dict(
+            testcase_name='rna_and_dna',
+            chains=[
+                folding_input.RnaChain(
+                    id='A', sequence='ACGU', modifications=[], unpaired_msa=''
+                ),
+                folding_input.DnaChain(id='B', sequence='ACG', modifications=[]),
+            ],
+            expected_num_tokens=7,
+        ),
+        dict(
+            # Phosphoserine has 11 heavy atoms, of which OXT is a leaving atom.
+            testcase_name='protein_with_ptm',
+            chains=[_protein('A', 'GGGG', ptms=[('SEP', 2)])],
+            expected_num_tokens=3 + 10,
+        ),
+        dict(
+            # Heme (C34 H32 Fe N4 O4) has 43 heavy atoms.
+            testcase_name='ccd_ligand',
+            chains=[
+                _protein('A', 'G' * 250),
+                folding_input.Ligand(id='B', ccd_ids=['HEM']),
+            ],
+            expected_num_tokens=250 + 43,
+        ),
+        dict(
+            testcase_name='smiles_ligand',
+            chains=[folding_input.Ligand(id='A', smiles='CCO')],
+            expected_num_tokens=3,
+        ),
+    )
+    def test_estimate_num_tokens(self, chains, expected_num_tokens):
+        fold_input = _fold_input('test', *chains)
+        self.assertEqual(run_af3.estimate_num_tokens(fold_input), expected_num_tokens)
+
+
+class AssignBucketTest(parameterized.TestCase):
+
+    @parameterized.named_parameters(
+        dict(
+            testcase_name='fits_smallest_bucket',
+            chains=[_protein('A', 'G' * 250)],
+            expected_bucket=256,
+        ),
+        dict(
+            testcase_name='ligand_crosses_bucket_edge',
+            chains=[
+                _protein('A', 'G' * 250),
+                folding_input.Ligand(id='B', ccd_ids=['HEM']),
+            ],
+            expected_bucket=512,
+        ),
+        dict(
+            testcase_name='larger_than_largest_bucket',
+            chains=[_protein('A', 'G' * 600)],
+            expected_bucket=600,
+        ),
+    )
+    def test_assign_bucket(self, chains, expected_bucket):
+        fold_input = _fold_input('test', *chains)
+        self.assertEqual(
+            run_af3.assign_bucket(fold_input, buckets=(256, 512)), expected_bucket
+        )
+
+
+class SortedFoldInputWindowsTest(parameterized.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._fold_inputs = [
+            _fold_input('large', _protein('A', 'G' * 300)),
+            _fold_input('small', _protein('A', 'G' * 20)),
+            _fold_input('medium', _protein('A', 'G' * 100)),
+            _fold_input(
+                'small_with_ligand',
+                _protein('A', 'G' * 250),
+                folding_input.Ligand(id='B', ccd_ids=['HEM']),
+            ),
+            _fold_input('tiny', _protein('A', 'G' * 10)),
+        ]
+
+    @parameterized.named_parameters(
+        dict(
+            testcase_name='windows_of_two',
+            window_size=2,
+            expected_names=[
+                ['small', 'large'],
+                ['medium', 'small_with_ligand'],
+                ['tiny'],
+            ],
+        ),
+        dict(
+            testcase_name='all_at_once',
+            window_size=0,
+            expected_names=[
+                ['tiny', 'small', 'medium', 'small_with_ligand', 'large'],
+            ],
+        ),
+    )
+    def test_sorted_fold_input_windows(self, window_size, expected_names):
+        windows = run_af3.sorted_fold_input_windows(
+            iter(self._fold_inputs), buckets=(256, 512), window_size=window_size
+        )
+        self.assertEqual(
+            [[fold_input.name for fold_input in window] for window in windows],
+            expected_names,
+        )
+
+
+class PrecompileFoldInputWindowTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._model_runner = mock.create_autospec(
+            run_af3.ModelRunner, instance=True
+        )
+        self._fold_inputs = [
+            _fold_input('a', _protein('A', 'G' * 100), rng_seeds=[1, 2]),
+            _fold_input('b', _protein('A', 'G' * 300), rng_seeds=[1, 2]),
+            _fold_input('c', _protein('A', 'G' * 100), rng_seeds=[1, 2, 3]),
+        ]
+
+    def test_compiles_single_seed_model_per_bucket(self):
+        run_af3.precompile_fold_input_window(
+            self._model_runner, self._fold_inputs, buckets=(256, 512)
+        )
+        self._model_runner.precompile.assert_called_once_with(
+            buckets=[256, 512], conformer_max_iterations=None, num_seeds=None
+        )
+
+    def test_compiles_batched_model_per_bucket_and_num_seeds(self):
+        run_af3.precompile_fold_input_window(
+            self._model_runner,
+            self._fold_inputs,
+            buckets=(256, 512),
+            batch_seeds=True,
+        )
+        self.assertCountEqual(
+            self._model_runner.precompile.call_args_list,
+            [
+                mock.call(
+                    buckets=[256, 512], conformer_max_iterations=None, num_seeds=2
+                ),
+                mock.call(
+                    buckets=[256], conformer_max_iterations=None, num_seeds=3
+                ),
+            ],
+        )
+
+
+class BatchedInferenceTest(absltest.TestCase):
+
+    def test_predict_structure_runs_seeds_as_one_batch(self):
+        fold_input = _fold_input('a', _protein('A', 'GGGG'), rng_seeds=[1, 2])
+        examples = [{'token_index': np.arange(4)} for _ in range(2)]
+        model_runner = mock.create_autospec(run_af3.ModelRunner, instance=True)
+        model_runner.run_inference_batched.return_value = [{}, {}]
+        model_runner.extract_structures.return_value = iter(())
+
+        with mock.patch.object(
+            run_af3, 'featurise_input_in_background', return_value=iter(examples)
+        ):
+            results = run_af3.predict_structure(
+                fold_input, model_runner, buckets=(256,), batch_seeds=True
+            )
+
+        model_runner.run_inference_batched.assert_called_once()
+        model_runner.run_inference.assert_not_called()
+        self.assertEqual([r.seed for r in results], [1, 2])
+
+    def test_run_inference_batched_uses_precompiled_model(self):
+        model_runner = run_af3.ModelRunner(
+            config=run_af3.make_model_config(flash_attention_implementation='xla'),
+            device=jax.local_devices(backend='cpu')[0],
+            model_dir=self.create_tempdir().full_path,
+        )
+        model_runner._model_params = {
+            '__meta__': {'__identifier__': np.frombuffer(b'test', np.uint8)}
+        }
+        compiled_model = mock.Mock(return_value={'x': np.zeros((2, 3))})
+        model_runner._compiled_batched_models[(4, 2)] = compiled_model
+
+        results = model_runner.run_inference_batched(
+            [{'token_index': np.arange(4, dtype=np.int32)} for _ in range(2)],
+            rng_keys=np.zeros((2, 2), np.uint32),
+        )
+
+        compiled_model.assert_called_once()
+        self.assertLen(results, 2)
+        self.assertEqual(results[0]['__identifier__'], b'test')
+
+
+class WriteOutputsTest(absltest.TestCase):
+
+    def test_duplicate_seeds(self):
+        fold_input = _fold_input('a', _protein('A', 'GGGG'), rng_seeds=[1, 1])
+        all_inference_results = [
+            run_af3.ResultsForSeed(
+                seed=1,
+                inference_results=[
+                    mock.Mock(metadata={'ranking_score': score})
+                    for score in (0.1, 0.2)
+                ],
+                full_fold_input=fold_input,
+                embeddings={'single_embeddings': np.zeros((4, 8))},
+            )
+            for _ in range(2)
+        ]
+        output_dir = self.create_tempdir().full_path
+
+        with mock.patch.object(
+            run_af3.post_processing, 'write_output', autospec=True
+        ) as write_output, mock.patch.object(
+            run_af3.post_processing, 'write_embeddings', autospec=True
+        ):
+            run_af3.write_outputs(
+                all_inference_results=all_inference_results,
+                output_dir=output_dir,
+                job_name='a',
+            )
+
+        self.assertCountEqual(
+            os.listdir(output_dir),
+            [
+                'seed-1_sample-0',
+                'seed-1_sample-1',
+                'seed-1_embeddings',
+                'ranking_scores.csv',
+            ],
+        )
+        # One write per sample, plus the top ranked sample.
+        self.assertEqual(write_output.call_count, 5)
+        with open(os.path.join(output_dir, 'ranking_scores.csv')) as f:
+            self.assertEqual(
+                f.read(),
+                'seed,sample,ranking_score\n'
+                '1,0,0.1\n1,1,0.2\n1,0,0.1\n1,1,0.2\n',
+            )
+
+    def test_writes_each_seed_as_it_is_produced(self):
+        fold_input = _fold_input('a', _protein('A', 'GGGG'), rng_seeds=[1, 2])
+        output_dir = self.create_tempdir().full_path
+
+        def all_inference_results():
+            for seed in fold_input.rng_seeds:
+                if seed == 2:
+                    # The first seed has been handed off before this one runs.
+                    self.assertTrue(
+                        os.path.isdir(os.path.join(output_dir, 'seed-1_sample-0'))
+                    )
+                yield run_af3.ResultsForSeed(
+                    seed=seed,
+                    inference_results=[mock.Mock(metadata={'ranking_score': 0.1})],
+                    full_fold_input=fold_input,
+                )
+
+        with mock.patch.object(
+            run_af3.post_processing, 'write_output', autospec=True
+        ):
+            run_af3.write_outputs(
+                all_inference_results=all_inference_results(),
+                output_dir=output_dir,
+                job_name='a',
+            )
+
+        self.assertTrue(
+            os.path.isdir(os.path.join(output_dir, 'seed-2_sample-0'))
+        )
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -50,17 +50,23 @@ def encode_record(scope: str, name: str, arr: np.ndarray) -> bytes:
   )
 
 
-def _read_record(stream: IO[bytes]) -> tuple[str, str, np.ndarray] | None:
-  """Reads a record encoded by `_encode_record` from a byte stream."""
+def _read_header(stream: IO[bytes]) -> tuple[int, ...] | None:
+  """Reads a record header, returning None at the end of the stream."""
   header_size = struct.calcsize('<5i')
   header = stream.read(header_size)
   if not header:
     return None
   if len(header) < header_size:
     raise RecordError(f'Incomplete header: {len(header)=} < {header_size=}')
-  (scope_len, name_len, dtype_len, shape_len, arr_buffer_len) = struct.unpack(
-      '<5i', header
-  )
+  return struct.unpack('<5i', header)
+
+
+def _read_record(stream: IO[bytes]) -> tuple[str, str, np.ndarray] | None:
+  """Reads a record encoded by `_encode_record` from a byte stream."""
+  header = _read_header(stream)
+  if header is None:
+    return None
+  (scope_len, name_len, dtype_len, shape_len, arr_buffer_len) = header
   fmt = f'<{scope_len}s{name_len}s{dtype_len}s{shape_len}i'
   payload_size = struct.calcsize(fmt) + arr_buffer_len
   payload = stream.read(payload_size)
@@ -208,3 +214,21 @@ def get_model_haiku_params(model_dir: pathlib.Path) -> hk.Params:
   if not params:
     raise FileNotFoundError(f'Model missing from "{model_dir}"')
   return params
+
+
+def check_model_haiku_params_exist(model_dir: pathlib.Path) -> None:
+  """Checks the model parameters can be read, without loading the weights.
+
+  Args:
+    model_dir: The directory containing the model parameter files.
+
+  Raises:
+    FileNotFoundError: If no model files are found in the model directory or
+      they are empty.
+    RecordError: If the header of the first parameter can't be read.
+  """
+  model_files, is_compressed = select_model_files(model_dir)
+  with open_for_reading(model_files, is_compressed) as stream:
+    header = _read_header(stream)
+  if header is None:
+    raise FileNotFoundError(f'Model missing from "{model_dir}"')